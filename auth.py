@@ -1,49 +1,156 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import threading
+import time
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import JWTError, jwt
 import bcrypt
+import jwt
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy import case, func
 from sqlalchemy.orm import Session
-from models import get_db, User
+from models import get_db, SessionLocal, User
 
 SECRET_KEY = "CHANGE-THIS-TO-A-REAL-SECRET-KEY-IN-PRODUCTION"  # TODO: use env var
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_DAYS = 30
+# bcrypt work factor; tune per host so a hash takes ~250ms
+BCRYPT_COST = int(os.getenv("BCRYPT_COST", "12"))
+
+# Server-side secret mixed into every new hash (HMAC-SHA256 before bcrypt).
+# Peppered hashes carry _PEPPERED_PREFIX; older hashes of the raw password still verify.
+BCRYPT_PEPPER = os.getenv("BCRYPT_PEPPER", "").encode("utf-8")
+_PEPPERED_PREFIX = "$rr1$"
+
+# Dedicated pool so bcrypt can't starve the threadpool that serves sync endpoints
+_BCRYPT_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="bcrypt")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
+# token digest -> (user id, exp), so repeat requests skip jwt.decode. TTLCache isn't
+# thread-safe and get_current_user runs in the threadpool, so guard every access.
+_token_cache = TTLCache(maxsize=10000, ttl=30)
+_token_cache_lock = threading.Lock()
+
+
+def _prehash(password: str) -> bytes:
+    # 64 hex chars: always under bcrypt's 72-byte input limit, so nothing is silently truncated
+    return hmac.new(BCRYPT_PEPPER, password.encode("utf-8"), hashlib.sha256).hexdigest().encode("ascii")
+
+
+def _sync_hash(password: str, cost: int = BCRYPT_COST) -> str:
+    hashed = bcrypt.hashpw(_prehash(password), bcrypt.gensalt(rounds=cost))
+    return _PEPPERED_PREFIX + hashed.decode("utf-8")
+
+
+def _sync_verify(plain_password: str, hashed_password: str) -> bool:
+    if hashed_password.startswith(_PEPPERED_PREFIX):
+        secret = _prehash(plain_password)
+        hashed = hashed_password[len(_PEPPERED_PREFIX):].encode("utf-8")
+    else:
+        secret = plain_password.encode("utf-8")
+        hashed = hashed_password.encode("utf-8")
+    return hmac.compare_digest(bcrypt.hashpw(secret, hashed), hashed)
+
+
+def _hash_cost(hashed_password: str) -> int:
+    # bcrypt hashes look like $2b$<cost>$<salt+digest>
+    return int(hashed_password.removeprefix(_PEPPERED_PREFIX).split("$")[2])
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """True for hashes without the pepper or at a cost other than BCRYPT_COST."""
+    return not hashed_password.startswith(_PEPPERED_PREFIX) or _hash_cost(hashed_password) != BCRYPT_COST
+
+
+def _stored_cost() -> int:
+    """The bcrypt cost most stored hashes use, or BCRYPT_COST for an empty table."""
+    cost = case(
+        (User.hashed_password.startswith(_PEPPERED_PREFIX), func.substr(User.hashed_password, len(_PEPPERED_PREFIX) + 5, 2)),
+        else_=func.substr(User.hashed_password, 5, 2),
+    )
+    db = SessionLocal()
+    try:
+        row = db.query(cost).group_by(cost).order_by(func.count().desc()).first()
+    finally:
+        db.close()
+    return int(row[0]) if row else BCRYPT_COST
+
+
+# Verified against when the email is unknown, so login takes the same time either way.
+# Built at the cost real accounts use: until they've all been rehashed on login,
+# that can differ from BCRYPT_COST.
+_dummy_hash: Optional[str] = None
+
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+def _sync_build_dummy_hash() -> str:
+    global _dummy_hash
+    _dummy_hash = _sync_hash("dummy-password", _stored_cost())
+    return _dummy_hash
 
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
+def dummy_password_hash() -> str:
+    return _dummy_hash or _sync_build_dummy_hash()
+
+
+# bcrypt is CPU-bound; run it on _BCRYPT_POOL so it doesn't block the event loop.
+async def hash_password(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_BCRYPT_POOL, _sync_hash, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(
+        _BCRYPT_POOL, _sync_verify, plain_password, hashed_password
+    )
+
+
+async def warm_up_bcrypt():
+    """Start a bcrypt worker thread and build the dummy hash ahead of the first login."""
+    await asyncio.get_running_loop().run_in_executor(_BCRYPT_POOL, _sync_build_dummy_hash)
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
+    # JWT subjects are strings; normalise here so decoding always sees the same type
+    if "sub" in to_encode:
+        to_encode["sub"] = str(to_encode["sub"])
     expire = datetime.utcnow() + (expires_delta or timedelta(days=ACCESS_TOKEN_EXPIRE_DAYS))
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def _token_cache_key(token: str) -> str:
+    return hashlib.blake2b(token.encode("utf-8"), digest_size=16).hexdigest()
+
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Ongeldige inloggegevens",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"verify_sub": False})
-        user_id = payload.get("sub")
-        if user_id is None:
+    cache_key = _token_cache_key(token)
+    with _token_cache_lock:
+        cached = _token_cache.get(cache_key)
+    # A hit skips jwt.decode and with it the exp check, so check exp here
+    if cached is not None and cached[1] > time.time():
+        user_id = cached[0]
+    else:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            user_id = int(payload["sub"])
+            exp = float(payload["exp"])
+        except (jwt.PyJWTError, KeyError, TypeError, ValueError):
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
+        with _token_cache_lock:
+            _token_cache[cache_key] = (user_id, exp)
 
-    user = db.query(User).filter(User.id == int(user_id)).first()
+    user = db.get(User, user_id)
     if user is None:
         raise credentials_exception
     return user
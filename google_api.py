@@ -14,9 +14,10 @@ Flow:
 - We fetch reviews using the Business Profile API
 """
 import os
+import urllib.parse
 import httpx
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, timezone
 
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID", "YOUR_GOOGLE_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET", "YOUR_GOOGLE_CLIENT_SECRET")
@@ -31,98 +32,136 @@ SCOPES = [
     "https://www.googleapis.com/auth/business.manage",
 ]
 
+# Static part of the OAuth consent URL, encoded once
+_BASE_PARAMS = {
+    "client_id": GOOGLE_CLIENT_ID,
+    "redirect_uri": GOOGLE_REDIRECT_URI,
+    "response_type": "code",
+    "scope": " ".join(SCOPES),
+    "access_type": "offline",
+    "prompt": "consent",
+}
+_BASE_QS = urllib.parse.urlencode(_BASE_PARAMS)
+
+# Shared client so all Google calls reuse pooled (HTTP/2) connections instead of
+# paying a TCP + TLS handshake per request. Opened/closed by the app lifecycle.
+_client: Optional[httpx.AsyncClient] = None
+
+
+async def open_client():
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+            timeout=10.0,
+        )
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    if _client is None:
+        raise RuntimeError("Google API client is not open; call open_client() on startup")
+    return _client
+
 
 def get_google_auth_url(state: str) -> str:
-    params = {
-        "client_id": GOOGLE_CLIENT_ID,
-        "redirect_uri": GOOGLE_REDIRECT_URI,
-        "response_type": "code",
-        "scope": " ".join(SCOPES),
-        "access_type": "offline",
-        "prompt": "consent",
-        "state": state,
-    }
-    query = "&".join(f"{k}={v}" for k, v in params.items())
-    return f"{GOOGLE_AUTH_URL}?{query}"
+    return f"{GOOGLE_AUTH_URL}?{_BASE_QS}&state={urllib.parse.quote(state)}"
 
 
 async def exchange_code_for_tokens(code: str) -> dict:
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(GOOGLE_TOKEN_URL, data={
-            "client_id": GOOGLE_CLIENT_ID,
-            "client_secret": GOOGLE_CLIENT_SECRET,
-            "code": code,
-            "grant_type": "authorization_code",
-            "redirect_uri": GOOGLE_REDIRECT_URI,
-        })
-        resp.raise_for_status()
-        return resp.json()
+    client = _get_client()
+    resp = await client.post(GOOGLE_TOKEN_URL, data={
+        "client_id": GOOGLE_CLIENT_ID,
+        "client_secret": GOOGLE_CLIENT_SECRET,
+        "code": code,
+        "grant_type": "authorization_code",
+        "redirect_uri": GOOGLE_REDIRECT_URI,
+    })
+    resp.raise_for_status()
+    return resp.json()
 
 
 async def refresh_access_token(refresh_token: str) -> str:
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(GOOGLE_TOKEN_URL, data={
-            "client_id": GOOGLE_CLIENT_ID,
-            "client_secret": GOOGLE_CLIENT_SECRET,
-            "refresh_token": refresh_token,
-            "grant_type": "refresh_token",
-        })
-        resp.raise_for_status()
-        return resp.json()["access_token"]
+    client = _get_client()
+    resp = await client.post(GOOGLE_TOKEN_URL, data={
+        "client_id": GOOGLE_CLIENT_ID,
+        "client_secret": GOOGLE_CLIENT_SECRET,
+        "refresh_token": refresh_token,
+        "grant_type": "refresh_token",
+    })
+    resp.raise_for_status()
+    return resp.json()["access_token"]
 
 
 async def get_accounts(access_token: str) -> list:
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{GOOGLE_BUSINESS_API}/accounts",
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
-        resp.raise_for_status()
-        return resp.json().get("accounts", [])
+    client = _get_client()
+    resp = await client.get(
+        f"{GOOGLE_BUSINESS_API}/accounts",
+        headers={"Authorization": f"Bearer {access_token}"}
+    )
+    resp.raise_for_status()
+    return resp.json().get("accounts", [])
 
 
 async def get_locations(access_token: str, account_id: str) -> list:
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{GOOGLE_BUSINESS_API}/{account_id}/locations",
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
-        resp.raise_for_status()
-        return resp.json().get("locations", [])
+    client = _get_client()
+    resp = await client.get(
+        f"{GOOGLE_BUSINESS_API}/{account_id}/locations",
+        headers={"Authorization": f"Bearer {access_token}"}
+    )
+    resp.raise_for_status()
+    return resp.json().get("locations", [])
 
 
 async def get_reviews(access_token: str, account_id: str, location_id: str) -> list:
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{GOOGLE_REVIEWS_API}/{account_id}/{location_id}/reviews",
-            headers={"Authorization": f"Bearer {access_token}"}
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        return data.get("reviews", [])
+    client = _get_client()
+    resp = await client.get(
+        f"{GOOGLE_REVIEWS_API}/{account_id}/{location_id}/reviews",
+        headers={"Authorization": f"Bearer {access_token}"}
+    )
+    resp.raise_for_status()
+    data = resp.json()
+    return data.get("reviews", [])
 
 
 async def reply_to_review(access_token: str, review_name: str, reply_text: str) -> dict:
-    async with httpx.AsyncClient() as client:
-        resp = await client.put(
-            f"{GOOGLE_REVIEWS_API}/{review_name}/reply",
-            headers={"Authorization": f"Bearer {access_token}"},
-            json={"comment": reply_text}
-        )
-        resp.raise_for_status()
-        return resp.json()
+    client = _get_client()
+    resp = await client.put(
+        f"{GOOGLE_REVIEWS_API}/{review_name}/reply",
+        headers={"Authorization": f"Bearer {access_token}"},
+        json={"comment": reply_text}
+    )
+    resp.raise_for_status()
+    return resp.json()
+
+
+_RATING_MAP = {"ONE": 1, "TWO": 2, "THREE": 3, "FOUR": 4, "FIVE": 5}
+_ANONYMOUS_AUTHOR = "Anoniem"
+
+
+def _parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """Parse a Google RFC 3339 timestamp into a naive UTC datetime, like the rest of our columns."""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc).replace(tzinfo=None)
 
 
 def parse_google_review(review: dict, user_id: int) -> dict:
     """Parse a Google review API response into our Review model fields."""
-    rating_map = {"ONE": 1, "TWO": 2, "THREE": 3, "FOUR": 4, "FIVE": 5}
     return {
         "user_id": user_id,
         "platform": "google",
         "external_id": review.get("reviewId") or review.get("name"),
-        "author_name": review.get("reviewer", {}).get("displayName", "Anoniem"),
-        "rating": rating_map.get(review.get("starRating"), None),
+        "author_name": review.get("reviewer", {}).get("displayName", _ANONYMOUS_AUTHOR),
+        "rating": _RATING_MAP.get(review.get("starRating"), None),
         "text": review.get("comment", ""),
-        "review_date": review.get("createTime"),
+        "review_date": _parse_timestamp(review.get("createTime")),
         "reply": review.get("reviewReply", {}).get("comment") if review.get("reviewReply") else None,
     }
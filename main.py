@@ -2,22 +2,46 @@
 ReviewRadar — FastAPI Backend
 Main application with all API routes.
 """
-from fastapi import FastAPI, Depends, HTTPException, Request, status
+import hashlib
+import threading
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import func, cast, delete, or_, tuple_, Integer
 from pydantic import BaseModel, EmailStr
-from typing import Optional, List
-from datetime import datetime, timedelta
+from cachetools import TTLCache
+from typing import Optional
+from datetime import datetime, timedelta, timezone
+from dateutil.relativedelta import relativedelta
 
 from models import get_db, User, Review, PlatformConnection
-from auth import hash_password, verify_password, create_access_token, get_current_user
-from google_api import get_google_auth_url, exchange_code_for_tokens, get_reviews, reply_to_review, parse_google_review
-from stripe_handler import create_checkout_session, create_portal_session, handle_webhook_event
+from auth import (
+    hash_password, verify_password, needs_rehash, create_access_token, get_current_user, warm_up_bcrypt,
+    dummy_password_hash,
+)
+from google_api import (
+    get_google_auth_url, exchange_code_for_tokens, get_reviews, reply_to_review, parse_google_review,
+    open_client, close_client,
+)
+from stripe_handler import create_checkout_session, create_portal_session, verify_webhook, process_webhook_event
 from notifications import notify_new_review
 
-app = FastAPI(title="ReviewRadar API", version="1.0.0")
+app = FastAPI(title="ReviewRadar API", version="1.0.0", default_response_class=ORJSONResponse)
+app.add_event_handler("startup", open_client)
+app.add_event_handler("startup", warm_up_bcrypt)
+app.add_event_handler("shutdown", close_client)
+
+# Public widget responses per user id; dropped whenever that user's reviews change.
+# TTLCache isn't thread-safe and the widget route runs in the threadpool, so lock it.
+_widget_cache = TTLCache(maxsize=10000, ttl=60)
+_widget_cache_lock = threading.Lock()
+
+
+def _invalidate_widget(user_id: int):
+    with _widget_cache_lock:
+        _widget_cache.pop(user_id, None)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,15 +68,6 @@ class TokenResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
 
-class ReviewResponse(BaseModel):
-    id: int
-    platform: str
-    author_name: Optional[str]
-    rating: Optional[float]
-    text: Optional[str]
-    reply: Optional[str]
-    review_date: Optional[str]
-
 class ReplyRequest(BaseModel):
     text: str
 
@@ -80,7 +95,7 @@ class UpdateProfileRequest(BaseModel):
 # ─── Auth Routes ─────────────────────────────────────────────────
 
 @app.post("/api/auth/register", response_model=TokenResponse)
-def register(req: RegisterRequest, db: Session = Depends(get_db)):
+async def register(req: RegisterRequest, db: Session = Depends(get_db)):
     try:
         existing = db.query(User).filter(User.email == req.email).first()
         if existing:
@@ -88,14 +103,14 @@ def register(req: RegisterRequest, db: Session = Depends(get_db)):
 
         user = User(
             email=req.email,
-            hashed_password=hash_password(req.password),
+            hashed_password=await hash_password(req.password),
             business_name=req.business_name,
         )
         db.add(user)
         db.commit()
         db.refresh(user)
 
-        token = create_access_token({"sub": str(user.id)})
+        token = create_access_token({"sub": user.id})
         return TokenResponse(access_token=token)
     except HTTPException:
         raise
@@ -104,12 +119,20 @@ def register(req: RegisterRequest, db: Session = Depends(get_db)):
 
 
 @app.post("/api/auth/login", response_model=TokenResponse)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = db.query(User).filter(User.email == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    hashed = user.hashed_password if user else dummy_password_hash()
+    password_ok = await verify_password(form_data.password, hashed)
+    if not user or not password_ok:
         raise HTTPException(status_code=401, detail="Onjuist e-mailadres of wachtwoord")
 
-    token = create_access_token({"sub": str(user.id)})
+    # There's no password-change flow, so login is the only chance to move an
+    # account onto the pepper and the current cost
+    if needs_rehash(hashed):
+        user.hashed_password = await hash_password(form_data.password)
+        db.commit()
+
+    token = create_access_token({"sub": user.id})
     return TokenResponse(access_token=token)
 
 
@@ -137,34 +160,82 @@ def update_profile(req: UpdateProfileRequest, user: User = Depends(get_current_u
     return {"status": "ok"}
 
 
+# ─── ETags ───────────────────────────────────────────────────────
+
+def review_etag(request: Request, response: Response, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """Answer 304 when the user's review data hasn't changed since the client's copy."""
+    count, last_fetched, last_replied = db.query(
+        func.count(Review.id), func.max(Review.fetched_at), func.max(Review.replied_at)
+    ).filter(Review.user_id == user.id).one()
+    connections = db.query(PlatformConnection).filter(PlatformConnection.user_id == user.id).count()
+    # The date is part of the stamp because stats buckets by the current month
+    stamp = (
+        f"{request.url.path}?{request.url.query}|{user.id}|{count}|{last_fetched}|{last_replied}"
+        f"|{connections}|{datetime.utcnow().date()}"
+    )
+    etag = f'W/"{hashlib.blake2b(stamp.encode("utf-8"), digest_size=16).hexdigest()}"'
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (t.strip() for t in if_none_match.split(",")):
+        raise HTTPException(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+
 # ─── Reviews ─────────────────────────────────────────────────────
 
-@app.get("/api/reviews", response_model=List[ReviewResponse])
+@app.get("/api/reviews", dependencies=[Depends(review_etag)])
 def list_reviews(
     platform: Optional[str] = None,
     rating: Optional[int] = None,
     limit: int = 50,
     offset: int = 0,
+    before: Optional[datetime] = None,
+    before_id: Optional[int] = None,
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    query = db.query(Review).filter(Review.user_id == user.id)
+    """List reviews newest first.
+
+    Page with ?before=<review_date>&before_id=<id> of the last review on the previous
+    page (keyset); `offset` is still accepted for older clients but gets slower per page.
+    Reviews without a date come last; once the last review seen has no date, page
+    on with just ?before_id=<id>.
+    """
+    # Plain rows and dicts: this is a hot read path, skip ORM hydration and output validation
+    query = db.query(
+        Review.id, Review.platform, Review.author_name, Review.rating, Review.text, Review.reply, Review.review_date,
+    ).filter(Review.user_id == user.id)
     if platform:
         query = query.filter(Review.platform == platform)
     if rating:
         query = query.filter(Review.rating == rating)
-    reviews = query.order_by(Review.review_date.desc()).offset(offset).limit(limit).all()
+    query = query.order_by(Review.review_date.desc().nulls_last(), Review.id.desc())
+    if before is not None:
+        if before.tzinfo is not None:
+            before = before.astimezone(timezone.utc).replace(tzinfo=None)
+        if before_id is not None:
+            after_cursor = tuple_(Review.review_date, Review.id) < (before, before_id)
+        else:
+            after_cursor = Review.review_date < before
+        # Undated reviews sort after every dated one, so they always follow the cursor
+        query = query.filter(or_(after_cursor, Review.review_date.is_(None)))
+    elif before_id is not None:
+        # Cursor inside the undated tail
+        query = query.filter(Review.review_date.is_(None), Review.id < before_id)
+    else:
+        query = query.offset(offset)
+    reviews = query.limit(limit).all()
 
     return [
-        ReviewResponse(
-            id=r.id,
-            platform=r.platform,
-            author_name=r.author_name,
-            rating=r.rating,
-            text=r.text,
-            reply=r.reply,
-            review_date=r.review_date.isoformat() if r.review_date else None,
-        )
+        {
+            "id": r.id,
+            "platform": r.platform,
+            "author_name": r.author_name,
+            "rating": r.rating,
+            "text": r.text,
+            "reply": r.reply,
+            "review_date": r.review_date.isoformat() if r.review_date else None,
+        }
         for r in reviews
     ]
 
@@ -193,48 +264,56 @@ async def reply_review(review_id: int, req: ReplyRequest, user: User = Depends(g
     review.reply = req.text
     review.replied_at = datetime.utcnow()
     db.commit()
+    _invalidate_widget(user.id)
     return {"status": "ok"}
 
 
 # ─── Stats ───────────────────────────────────────────────────────
 
-@app.get("/api/stats", response_model=StatsResponse)
+@app.get("/api/stats", response_model=StatsResponse, dependencies=[Depends(review_etag)])
 def get_stats(user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    reviews = db.query(Review).filter(Review.user_id == user.id).all()
     connections = db.query(PlatformConnection).filter(PlatformConnection.user_id == user.id).count()
 
     now = datetime.utcnow()
     month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 
-    total = len(reviews)
-    avg = sum(r.rating or 0 for r in reviews) / total if total > 0 else 0
-    this_month = sum(1 for r in reviews if r.review_date and r.review_date >= month_start)
+    # Missing ratings count as 0 in the averages
+    rating = func.coalesce(Review.rating, 0)
+    total, avg, this_month = db.query(
+        func.count(Review.id),
+        func.avg(rating),
+        func.count(Review.id).filter(Review.review_date >= month_start),
+    ).filter(Review.user_id == user.id).one()
+    avg = avg or 0
 
     # Rating distribution
+    star = cast(Review.rating, Integer)
     dist = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-    for r in reviews:
-        if r.rating:
-            dist[int(r.rating)] = dist.get(int(r.rating), 0) + 1
+    dist.update(
+        db.query(star, func.count(Review.id))
+        .filter(Review.user_id == user.id, Review.rating >= 1)
+        .group_by(star)
+        .all()
+    )
 
     # Monthly trend (last 6 months)
+    months = [month_start - relativedelta(months=i) for i in range(5, -1, -1)]
+
+    month_key = func.strftime("%Y-%m", Review.review_date)
+    monthly = {
+        key: (count, month_avg)
+        for key, count, month_avg in db.query(month_key, func.count(Review.id), func.avg(rating))
+        .filter(Review.user_id == user.id, Review.review_date >= months[0])
+        .group_by(month_key)
+        .all()
+    }
     trend = []
-    for i in range(5, -1, -1):
-        month = now.month - i
-        year = now.year
-        while month <= 0:
-            month += 12
-            year -= 1
-        m_start = datetime(year, month, 1)
-        if month == 12:
-            m_end = datetime(year + 1, 1, 1)
-        else:
-            m_end = datetime(year, month + 1, 1)
-        month_reviews = [r for r in reviews if r.review_date and m_start <= r.review_date < m_end]
-        month_avg = sum(r.rating or 0 for r in month_reviews) / len(month_reviews) if month_reviews else 0
+    for m_start in months:
+        count, month_avg = monthly.get(m_start.strftime("%Y-%m"), (0, 0))
         trend.append({
             "month": m_start.strftime("%b %Y"),
-            "count": len(month_reviews),
-            "average": round(month_avg, 1),
+            "count": count,
+            "average": round(month_avg or 0, 1),
         })
 
     return StatsResponse(
@@ -298,30 +377,47 @@ async def sync_google_reviews(user: User = Depends(get_current_user), db: Sessio
     except Exception:
         raise HTTPException(status_code=500, detail="Kon reviews niet ophalen van Google")
 
-    new_count = 0
-    for raw in raw_reviews:
-        parsed = parse_google_review(raw, user.id)
-        existing = db.query(Review).filter(
+    parsed_reviews = [parse_google_review(raw, user.id) for raw in raw_reviews]
+    ext_ids = [p["external_id"] for p in parsed_reviews]
+    existing = {
+        ext_id for (ext_id,) in db.query(Review.external_id).filter(
             Review.user_id == user.id,
-            Review.external_id == parsed["external_id"]
-        ).first()
-        if not existing:
-            review = Review(**parsed)
-            db.add(review)
-            new_count += 1
-            # Send notification
-            db.flush()
-            notify_new_review(user, review)
+            Review.external_id.in_(ext_ids)
+        ).all()
+    }
+
+    new_rows = []
+    for parsed in parsed_reviews:
+        if parsed["external_id"] not in existing:
+            existing.add(parsed["external_id"])
+            new_rows.append(parsed)
+
+    if new_rows:
+        db.bulk_insert_mappings(Review, new_rows)
+        db.commit()
+        _invalidate_widget(user.id)
 
-    db.commit()
-    return {"synced": new_count}
+    # Send notifications
+    if new_rows and user.email_notifications:
+        new_reviews = db.query(Review).filter(
+            Review.user_id == user.id,
+            Review.external_id.in_([row["external_id"] for row in new_rows])
+        ).all()
+        for review in new_reviews:
+            notify_new_review(user, review)
+    return {"synced": len(new_rows)}
 
 
 # ─── Connections ─────────────────────────────────────────────────
 
 @app.get("/api/connections")
 def list_connections(user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    conns = db.query(PlatformConnection).filter(PlatformConnection.user_id == user.id).all()
+    conns = db.query(
+        PlatformConnection.id,
+        PlatformConnection.platform,
+        PlatformConnection.account_name,
+        PlatformConnection.connected_at,
+    ).filter(PlatformConnection.user_id == user.id).all()
     return [
         {
             "id": c.id,
@@ -335,13 +431,14 @@ def list_connections(user: User = Depends(get_current_user), db: Session = Depen
 
 @app.delete("/api/connections/{conn_id}")
 def delete_connection(conn_id: int, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    conn = db.query(PlatformConnection).filter(
-        PlatformConnection.id == conn_id,
-        PlatformConnection.user_id == user.id
-    ).first()
-    if not conn:
+    deleted = db.execute(
+        delete(PlatformConnection).where(
+            PlatformConnection.id == conn_id,
+            PlatformConnection.user_id == user.id
+        )
+    ).rowcount
+    if not deleted:
         raise HTTPException(status_code=404, detail="Verbinding niet gevonden")
-    db.delete(conn)
     db.commit()
     return {"status": "ok"}
 
@@ -351,9 +448,7 @@ def delete_connection(conn_id: int, user: User = Depends(get_current_user), db:
 @app.post("/api/billing/checkout")
 def billing_checkout(plan: str, user: User = Depends(get_current_user), db: Session = Depends(get_db)):
     try:
-        url = create_checkout_session(user, plan)
-        # Save customer ID if newly created
-        db.commit()
+        url = create_checkout_session(user, plan, db)
         return {"url": url}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -368,15 +463,40 @@ def billing_portal(user: User = Depends(get_current_user)):
         raise HTTPException(status_code=400, detail=str(e))
 
 
+MAX_WEBHOOK_BYTES = 64 * 1024
+
+
+async def read_limited_body(request: Request, max_bytes: int) -> bytes:
+    """Read the request body, rejecting it with 413 as soon as it exceeds max_bytes."""
+    too_large = HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Payload too large")
+    content_length = request.headers.get("content-length")
+    if content_length is not None and (not content_length.isdigit() or int(content_length) > max_bytes):
+        raise too_large
+
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_bytes:
+            raise too_large
+    return bytes(body)
+
+
 @app.post("/api/webhooks/stripe")
 async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
-    payload = await request.body()
+    payload = await read_limited_body(request, MAX_WEBHOOK_BYTES)
     sig = request.headers.get("stripe-signature", "")
     try:
-        result = handle_webhook_event(payload, sig, db)
-        return result
+        verify_webhook(payload, sig)
     except ValueError:
         raise HTTPException(status_code=400, detail="Invalid webhook")
+    # Applied before acknowledging: there is no durable queue, so a failure must
+    # return 5xx for Stripe to redeliver the event rather than be lost
+    try:
+        return process_webhook_event(payload, db)
+    except Exception as e:
+        db.rollback()
+        print(f"[STRIPE] Webhook processing failed: {type(e).__name__}: {e}")
+        raise HTTPException(status_code=500, detail="Webhook processing failed")
 
 
 # ─── Widget API (public) ────────────────────────────────────────
@@ -384,7 +504,12 @@ async def stripe_webhook(request: Request, db: Session = Depends(get_db)):
 @app.get("/api/widget/{user_id}")
 def widget_reviews(user_id: int, db: Session = Depends(get_db)):
     """Public endpoint for the embeddable widget. Returns top reviews."""
-    user = db.query(User).filter(User.id == user_id).first()
+    with _widget_cache_lock:
+        cached = _widget_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    user = db.get(User, user_id)
     if not user or user.plan != "pro":
         raise HTTPException(status_code=403, detail="Widget is alleen beschikbaar voor Pro gebruikers")
 
@@ -395,7 +520,7 @@ def widget_reviews(user_id: int, db: Session = Depends(get_db)):
         .limit(10)
         .all()
     )
-    return [
+    result = [
         {
             "author": r.author_name,
             "rating": r.rating,
@@ -405,6 +530,9 @@ def widget_reviews(user_id: int, db: Session = Depends(get_db)):
         }
         for r in reviews
     ]
+    with _widget_cache_lock:
+        _widget_cache[user_id] = result
+    return result
 
 
 # ─── Demo Data (for testing) ────────────────────────────────────
@@ -436,27 +564,30 @@ def seed_demo_data(user: User = Depends(get_current_user), db: Session = Depends
     ]
 
     now = datetime.utcnow()
-    for i in range(20):
-        rating = random.choices([5, 4, 3, 2, 1], weights=[40, 30, 15, 10, 5])[0]
-        if rating >= 4:
-            text = random.choice(texts_positive)
-        elif rating == 3:
-            text = random.choice(texts_neutral)
-        else:
-            text = random.choice(texts_negative)
-
-        review = Review(
-            user_id=user.id,
-            platform=random.choice(platforms),
-            author_name=random.choice(names),
-            rating=rating,
-            text=text,
-            review_date=now - timedelta(days=random.randint(0, 180)),
+    count = 20
+    ratings = random.choices([5, 4, 3, 2, 1], weights=[40, 30, 15, 10, 5], k=count)
+    rows = [
+        {
+            "user_id": user.id,
+            "platform": platform,
+            "author_name": name,
+            "rating": rating,
+            "text": random.choice(
+                texts_positive if rating >= 4 else texts_neutral if rating == 3 else texts_negative
+            ),
+            "review_date": now - timedelta(days=days),
+        }
+        for rating, platform, name, days in zip(
+            ratings,
+            random.choices(platforms, k=count),
+            random.choices(names, k=count),
+            random.choices(range(181), k=count),
         )
-        db.add(review)
-
+    ]
+    db.bulk_insert_mappings(Review, rows)
     db.commit()
-    return {"seeded": 20}
+    _invalidate_widget(user.id)
+    return {"seeded": count}
 
 
 # ─── Health Check ────────────────────────────────────────────────
@@ -467,11 +598,11 @@ def health():
     return {"status": "ok", "service": "ReviewRadar API", "version": "1.0.0", "python": sys.version}
 
 @app.get("/api/debug/test-hash")
-def debug_test_hash():
+async def debug_test_hash():
     try:
         from auth import hash_password, verify_password
-        h = hash_password("test123")
-        v = verify_password("test123", h)
+        h = await hash_password("test123")
+        v = await verify_password("test123", h)
         return {"hash": h[:20] + "...", "verify": v}
     except Exception as e:
         return {"error": f"{type(e).__name__}: {str(e)}"}
@@ -479,21 +610,18 @@ def debug_test_hash():
 @app.get("/api/debug/token-check")
 def debug_token_check(token: str, db: Session = Depends(get_db)):
     """Debug: decode a token and check if user exists."""
-    from jose import jwt as jwt_lib
+    import jwt as jwt_lib
     from auth import SECRET_KEY, ALGORITHM
     try:
         payload = jwt_lib.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id = payload.get("sub")
         user = db.query(User).filter(User.id == user_id).first()
-        all_users = db.query(User).all()
         return {
             "payload": payload,
             "user_id_from_token": user_id,
             "user_id_type": type(user_id).__name__,
             "user_found": user is not None,
             "user_email": user.email if user else None,
-            "total_users": len(all_users),
-            "all_user_ids": [u.id for u in all_users],
         }
     except Exception as e:
         return {"error": f"{type(e).__name__}: {str(e)}"}
@@ -1,10 +1,24 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Boolean, Text, ForeignKey
+from sqlalchemy import create_engine, event, Column, Integer, String, Float, DateTime, Boolean, Text, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
 
 DATABASE_URL = "sqlite:///./reviewradar.db"
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run during writes; NORMAL sync is safe with WAL
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -33,6 +47,10 @@ class User(Base):
     connections = relationship("PlatformConnection", back_populates="user")
     reviews = relationship("Review", back_populates="user")
 
+    __table_args__ = (
+        Index("ix_users_stripe_customer_id", "stripe_customer_id", unique=True),
+    )
+
 
 class PlatformConnection(Base):
     __tablename__ = "platform_connections"
@@ -48,6 +66,10 @@ class PlatformConnection(Base):
 
     user = relationship("User", back_populates="connections")
 
+    __table_args__ = (
+        Index("ix_conn_user_platform", "user_id", "platform"),
+    )
+
 
 class Review(Base):
     __tablename__ = "reviews"
@@ -67,6 +89,17 @@ class Review(Base):
 
     user = relationship("User", back_populates="reviews")
 
+    __table_args__ = (
+        Index("ix_reviews_user_date", "user_id", "review_date"),
+        Index("ix_reviews_user_extid", "user_id", "external_id"),
+        Index("ix_reviews_user_rating", "user_id", "rating"),
+    )
+
 
 # Create all tables
 Base.metadata.create_all(bind=engine)
+# create_all skips tables that already exist, indexes included, so older databases
+# would never get indexes added to the models later; create any missing ones here
+for _table in Base.metadata.sorted_tables:
+    for _index in _table.indexes:
+        _index.create(bind=engine, checkfirst=True)
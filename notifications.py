@@ -2,100 +2,262 @@
 Email notification system for new reviews.
 Uses SMTP for sending emails. Configure via environment variables.
 """
+import atexit
+import io
 import os
+import re
 import smtplib
+import threading
+from collections import deque
+from itertools import groupby
+from email.generator import BytesGenerator
+from email.message import Message
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from typing import List
+from datetime import datetime, timedelta
+from typing import Iterable, List, Sequence, Tuple
+from sqlalchemy import func
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session
-from models import User, Review
+from models import SessionLocal, User, Review
+from notifications_templates import NEW_REVIEW_TMPL, DIGEST_TMPL, platform_title
+from tasks import enqueue
 
 SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 SMTP_USER = os.getenv("SMTP_USER", "")
 SMTP_PASS = os.getenv("SMTP_PASS", "")
 FROM_EMAIL = os.getenv("FROM_EMAIL", "noreply@reviewradar.nl")
+# Characters that must not reach a mail header (header injection)
+_SAFE_HDR = re.compile(r"[\r\n\x00]")
+# Characters of review text shown per digest row
+DIGEST_SNIPPET_LEN = 80
+# Batched sends start a fresh SMTP session after this many messages
+DIGEST_RECONNECT_EVERY = 100
 
 
-def send_email(to_email: str, subject: str, html_body: str):
-    if not SMTP_USER or not SMTP_PASS:
-        print(f"[NOTIFICATION] Email skipped (no SMTP config): {subject} -> {to_email}")
+# One authenticated SMTP connection per thread, reused across sends
+_pool = threading.local()
+_open_conns = set()
+_open_conns_lock = threading.Lock()
+
+
+def _drop_conn():
+    conn = getattr(_pool, "conn", None)
+    _pool.conn = None
+    if conn is None:
         return
+    with _open_conns_lock:
+        _open_conns.discard(conn)
+    try:
+        conn.quit()
+    except (smtplib.SMTPException, OSError):
+        conn.close()
+
+
+def _get_conn() -> smtplib.SMTP:
+    conn = getattr(_pool, "conn", None)
+    if conn is not None:
+        try:
+            if conn.noop()[0] == 250:
+                return conn
+        except (smtplib.SMTPException, OSError):
+            pass
+        _drop_conn()
+
+    conn = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+    conn.starttls()
+    conn.login(SMTP_USER, SMTP_PASS)
+    _pool.conn = conn
+    with _open_conns_lock:
+        _open_conns.add(conn)
+    return conn
+
+
+def close_pool():
+    with _open_conns_lock:
+        conns = list(_open_conns)
+        _open_conns.clear()
+    for conn in conns:
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
+
+
+atexit.register(close_pool)
+
 
+def is_email_enabled() -> bool:
+    return bool(SMTP_USER and SMTP_PASS)
+
+
+def _hsan(value) -> str:
+    return _SAFE_HDR.sub(" ", value or "")
+
+
+def _build_message(to_email: str, subject: str, html_body: str) -> MIMEMultipart:
     msg = MIMEMultipart("alternative")
     msg["Subject"] = subject
     msg["From"] = FROM_EMAIL
     msg["To"] = to_email
     msg.attach(MIMEText(html_body, "html"))
+    return msg
+
+
+def _build_digest_message(to_email: str, subject: str, reviews: Sequence[Row]) -> MIMEMultipart:
+    # Same multipart/alternative layout as single notifications
+    return _build_message(to_email, subject, DIGEST_TMPL.render(reviews=reviews))
+
+
+def _message_bytes(msg: Message) -> bytes:
+    # BytesGenerator writes the wire format directly, skipping as_string()'s str round-trip.
+    # sendmail() only normalises line endings for str, so emit SMTP's CRLF here.
+    buf = io.BytesIO()
+    BytesGenerator(buf, mangle_from_=False).flatten(msg, linesep="\r\n")
+    return buf.getvalue()
+
+
+def _is_permanent(e: smtplib.SMTPException) -> bool:
+    """True for 5xx replies, which retrying won't fix; 4xx and dropped connections are transient."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in e.recipients.values())
+    return isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+
+
+def send_email(to_email: str, subject: str, html_body: str):
+    if not is_email_enabled():
+        print(f"[NOTIFICATION] Email skipped (no SMTP config): {subject} -> {to_email}")
+        return
 
-    with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-        server.starttls()
-        server.login(SMTP_USER, SMTP_PASS)
-        server.sendmail(FROM_EMAIL, to_email, msg.as_string())
+    wire = _message_bytes(_build_message(to_email, subject, html_body))
+    try:
+        try:
+            _get_conn().sendmail(FROM_EMAIL, to_email, wire)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError):
+            # Pooled connection went stale between the NOOP and the send; retry once on a fresh one
+            _drop_conn()
+            _get_conn().sendmail(FROM_EMAIL, to_email, wire)
+    except smtplib.SMTPException as e:
+        # Let send_email_task retry transient failures only
+        if not _is_permanent(e):
+            raise
+        print(f"[NOTIFICATION] Email rejected, dropping: {subject} -> {to_email}: {type(e).__name__}: {e}")
+
+
+def send_email_task(to_email: str, subject: str, html_body: str):
+    """Queue an email for background delivery, retrying transient SMTP failures (4xx, connection errors)."""
+    enqueue(
+        send_email, to_email, subject, html_body,
+        retry_on=(smtplib.SMTPException, OSError), max_retries=5, retry_delay=30,
+    )
 
 
 def notify_new_review(user: User, review: Review):
-    if not user.email_notifications:
+    # Nothing would be sent, so don't render anything either
+    if not is_email_enabled() or not user.email_notifications:
         return
 
-    stars = "★" * int(review.rating or 0) + "☆" * (5 - int(review.rating or 0))
-    html = f"""
-    <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-        <div style="background: linear-gradient(135deg, #1e3a5f 0%, #2563eb 100%); padding: 24px; border-radius: 12px 12px 0 0;">
-            <h1 style="color: white; margin: 0; font-size: 24px;">Review<span style="color: #facc15;">Radar</span></h1>
-        </div>
-        <div style="background: white; padding: 24px; border: 1px solid #e5e7eb; border-top: none; border-radius: 0 0 12px 12px;">
-            <h2 style="margin-top: 0;">Nieuwe review ontvangen!</h2>
-            <div style="background: #f9fafb; border-radius: 8px; padding: 16px; margin: 16px 0;">
-                <p style="margin: 0 0 8px 0;"><strong>{review.author_name}</strong> op <strong>{review.platform.title()}</strong></p>
-                <p style="margin: 0 0 8px 0; color: #eab308; font-size: 20px;">{stars}</p>
-                <p style="margin: 0; color: #4b5563;">{review.text or '(Geen tekst)'}</p>
-            </div>
-            <a href="https://reviewradar.nl/dashboard.html" style="display: inline-block; background: #2563eb; color: white; padding: 12px 24px; border-radius: 8px; text-decoration: none; font-weight: bold;">Bekijk & Reageer</a>
-        </div>
-    </div>
-    """
-    subject = f"Nieuwe {review.platform.title()} review ({int(review.rating or 0)}★) — {review.author_name}"
-    send_email(user.email, subject, html)
+    author = _hsan(review.author_name)
+    platform = platform_title(_hsan(review.platform))
+    html = NEW_REVIEW_TMPL.render(review=review, author=author, platform=platform)
+    subject = f"Nieuwe {platform} review ({int(review.rating or 0)}★) — {author}"
+    send_email_task(user.email, subject, html)
 
 
-def send_daily_digest(user: User, new_reviews: List[Review]):
-    if not user.email_notifications or not new_reviews:
+def _send_messages(pending: deque):
+    """Send (to_email, subject, wire bytes) items over one SMTP session.
+
+    Sent items are popped, so a retry resumes where the previous attempt failed.
+    A message the server permanently rejects is logged and dropped, so it can't
+    block the ones behind it; connection-level errors propagate for a retry.
+    """
+    if not is_email_enabled():
+        for to_email, subject, _ in pending:
+            print(f"[NOTIFICATION] Email skipped (no SMTP config): {subject} -> {to_email}")
+        pending.clear()
         return
 
-    review_rows = ""
-    for r in new_reviews:
-        stars = "★" * int(r.rating or 0) + "☆" * (5 - int(r.rating or 0))
-        review_rows += f"""
-        <tr>
-            <td style="padding: 8px; border-bottom: 1px solid #e5e7eb;">{r.platform.title()}</td>
-            <td style="padding: 8px; border-bottom: 1px solid #e5e7eb; color: #eab308;">{stars}</td>
-            <td style="padding: 8px; border-bottom: 1px solid #e5e7eb;">{r.author_name}</td>
-            <td style="padding: 8px; border-bottom: 1px solid #e5e7eb;">{(r.text or '')[:80]}...</td>
-        </tr>
-        """
-
-    html = f"""
-    <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
-        <div style="background: linear-gradient(135deg, #1e3a5f 0%, #2563eb 100%); padding: 24px; border-radius: 12px 12px 0 0;">
-            <h1 style="color: white; margin: 0; font-size: 24px;">Review<span style="color: #facc15;">Radar</span></h1>
-        </div>
-        <div style="background: white; padding: 24px; border: 1px solid #e5e7eb; border-top: none; border-radius: 0 0 12px 12px;">
-            <h2 style="margin-top: 0;">Dagelijks overzicht — {len(new_reviews)} nieuwe review(s)</h2>
-            <table style="width: 100%; border-collapse: collapse;">
-                <thead>
-                    <tr style="background: #f3f4f6;">
-                        <th style="padding: 8px; text-align: left;">Platform</th>
-                        <th style="padding: 8px; text-align: left;">Rating</th>
-                        <th style="padding: 8px; text-align: left;">Auteur</th>
-                        <th style="padding: 8px; text-align: left;">Review</th>
-                    </tr>
-                </thead>
-                <tbody>{review_rows}</tbody>
-            </table>
-            <a href="https://reviewradar.nl/dashboard.html" style="display: inline-block; background: #2563eb; color: white; padding: 12px 24px; border-radius: 8px; text-decoration: none; font-weight: bold; margin-top: 16px;">Bekijk alle reviews</a>
-        </div>
-    </div>
+    conn = _get_conn()
+    sent = 0
+    while pending:
+        if sent and sent % DIGEST_RECONNECT_EVERY == 0:
+            _drop_conn()
+            conn = _get_conn()
+        to_email, subject, wire = pending[0]
+        try:
+            conn.sendmail(FROM_EMAIL, to_email, wire)
+        except smtplib.SMTPRecipientsRefused as e:
+            if not _is_permanent(e):
+                raise
+            print(f"[NOTIFICATION] Recipient refused, dropping: {subject} -> {to_email}: {e.recipients}")
+        except smtplib.SMTPDataError as e:
+            if not _is_permanent(e):
+                raise
+            print(f"[NOTIFICATION] Message rejected, dropping: {subject} -> {to_email}: {e.smtp_code} {e.smtp_error!r}")
+        pending.popleft()
+        sent += 1
+
+
+def digest_reviews(db: Session, since: datetime) -> List[Row]:
+    """Every opted-in user's reviews fetched since `since`, in one query ordered by user.
+
+    Only the columns the digest shows are selected, with the text truncated in SQL.
     """
-    subject = f"ReviewRadar — {len(new_reviews)} nieuwe review(s) vandaag"
-    send_email(user.email, subject, html)
+    return (
+        db.query(
+            User.id.label("user_id"),
+            User.email,
+            Review.platform,
+            Review.rating,
+            Review.author_name,
+            func.substr(Review.text, 1, DIGEST_SNIPPET_LEN).label("text_snippet"),
+        )
+        .join(Review, Review.user_id == User.id)
+        .filter(User.email_notifications.is_(True), Review.fetched_at >= since)
+        .order_by(User.id, Review.review_date.desc())
+        .all()
+    )
+
+
+def _queue_digests(digests: Iterable[Tuple[str, Sequence[Row]]]):
+    """Render each (to_email, reviews) digest and send them all through a single SMTP session."""
+    pending = deque()
+    for to_email, new_reviews in digests:
+        subject = f"ReviewRadar — {len(new_reviews)} nieuwe review(s) vandaag"
+        pending.append((to_email, subject, _message_bytes(_build_digest_message(to_email, subject, new_reviews))))
+
+    if pending:
+        enqueue(_send_messages, pending, retry_on=(smtplib.SMTPException, OSError), max_retries=5, retry_delay=30)
+
+
+def send_daily_digests(pairs: List[Tuple[User, Sequence[Row]]]):
+    """Render every user's digest and send them all through a single SMTP session."""
+    if not is_email_enabled():
+        return
+    _queue_digests(
+        (user.email, new_reviews) for user, new_reviews in pairs if user.email_notifications and new_reviews
+    )
+
+
+def send_daily_digest(user: User, new_reviews: Sequence[Row]):
+    send_daily_digests([(user, new_reviews)])
+
+
+def send_all_daily_digests(db: Session, since: datetime):
+    """Send every opted-in user a digest of the reviews fetched since `since`."""
+    if not is_email_enabled():
+        return
+    # One query for all users; opted-out users and users without new reviews never match
+    rows = digest_reviews(db, since)
+    _queue_digests((email, list(group)) for (_, email), group in groupby(rows, key=lambda r: (r.user_id, r.email)))
+
+
+if __name__ == "__main__":
+    # Daily digest run, e.g. from cron: python notifications.py
+    db = SessionLocal()
+    try:
+        send_all_daily_digests(db, datetime.utcnow() - timedelta(days=1))
+    finally:
+        db.close()
+    # The queued sends finish before the interpreter exits; pending retries don't
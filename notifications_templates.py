@@ -0,0 +1,79 @@
+"""
+Email templates for notifications.py, compiled once at import.
+Autoescaping is on, so review content from the platforms can't inject HTML.
+"""
+from functools import lru_cache
+from jinja2 import BaseLoader, Environment, select_autoescape
+
+env = Environment(
+    loader=BaseLoader(),
+    autoescape=select_autoescape(["html"], default_for_string=True),
+    auto_reload=False,
+    cache_size=-1,
+)
+
+# Star strings for ratings 0-5, indexed by rating
+STARS = tuple("★" * k + "☆" * (5 - k) for k in range(6))
+
+
+def _stars(rating) -> str:
+    return STARS[min(5, max(0, int(rating or 0)))]
+
+
+@lru_cache(maxsize=32)
+def platform_title(platform: str) -> str:
+    # Platforms come from a handful of names, so this is almost always a cache hit
+    return platform.title()
+
+
+env.filters["stars"] = _stars
+env.filters["platform_title"] = platform_title
+
+NEW_REVIEW_TMPL = env.from_string("""
+    <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+        <div style="background: linear-gradient(135deg, #1e3a5f 0%, #2563eb 100%); padding: 24px; border-radius: 12px 12px 0 0;">
+            <h1 style="color: white; margin: 0; font-size: 24px;">Review<span style="color: #facc15;">Radar</span></h1>
+        </div>
+        <div style="background: white; padding: 24px; border: 1px solid #e5e7eb; border-top: none; border-radius: 0 0 12px 12px;">
+            <h2 style="margin-top: 0;">Nieuwe review ontvangen!</h2>
+            <div style="background: #f9fafb; border-radius: 8px; padding: 16px; margin: 16px 0;">
+                <p style="margin: 0 0 8px 0;"><strong>{{ author }}</strong> op <strong>{{ platform }}</strong></p>
+                <p style="margin: 0 0 8px 0; color: #eab308; font-size: 20px;">{{ review.rating|stars }}</p>
+                <p style="margin: 0; color: #4b5563;">{{ review.text or '(Geen tekst)' }}</p>
+            </div>
+            <a href="https://reviewradar.nl/dashboard.html" style="display: inline-block; background: #2563eb; color: white; padding: 12px 24px; border-radius: 8px; text-decoration: none; font-weight: bold;">Bekijk & Reageer</a>
+        </div>
+    </div>
+""")
+
+DIGEST_TMPL = env.from_string("""
+    <div style="font-family: Arial, sans-serif; max-width: 600px; margin: 0 auto;">
+        <div style="background: linear-gradient(135deg, #1e3a5f 0%, #2563eb 100%); padding: 24px; border-radius: 12px 12px 0 0;">
+            <h1 style="color: white; margin: 0; font-size: 24px;">Review<span style="color: #facc15;">Radar</span></h1>
+        </div>
+        <div style="background: white; padding: 24px; border: 1px solid #e5e7eb; border-top: none; border-radius: 0 0 12px 12px;">
+            <h2 style="margin-top: 0;">Dagelijks overzicht — {{ reviews|length }} nieuwe review(s)</h2>
+            <table style="width: 100%; border-collapse: collapse;">
+                <thead>
+                    <tr style="background: #f3f4f6;">
+                        <th style="padding: 8px; text-align: left;">Platform</th>
+                        <th style="padding: 8px; text-align: left;">Rating</th>
+                        <th style="padding: 8px; text-align: left;">Auteur</th>
+                        <th style="padding: 8px; text-align: left;">Review</th>
+                    </tr>
+                </thead>
+                <tbody>
+                {%- for r in reviews %}
+                    <tr>
+                        <td style="padding: 8px; border-bottom: 1px solid #e5e7eb;">{{ r.platform|platform_title }}</td>
+                        <td style="padding: 8px; border-bottom: 1px solid #e5e7eb; color: #eab308;">{{ r.rating|stars }}</td>
+                        <td style="padding: 8px; border-bottom: 1px solid #e5e7eb;">{{ r.author_name }}</td>
+                        <td style="padding: 8px; border-bottom: 1px solid #e5e7eb;">{{ r.text_snippet or '' }}...</td>
+                    </tr>
+                {%- endfor %}
+                </tbody>
+            </table>
+            <a href="https://reviewradar.nl/dashboard.html" style="display: inline-block; background: #2563eb; color: white; padding: 12px 24px; border-radius: 8px; text-decoration: none; font-weight: bold; margin-top: 16px;">Bekijk alle reviews</a>
+        </div>
+    </div>
+""")
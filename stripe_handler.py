@@ -3,7 +3,11 @@ Stripe subscription management.
 Set STRIPE_SECRET_KEY and STRIPE_WEBHOOK_SECRET environment variables.
 """
 import os
+import time
+from typing import Callable, Dict
+import orjson
 import stripe
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 from models import User
 
@@ -19,31 +23,34 @@ PRICE_IDS = {
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
 
 
-def create_checkout_session(user: User, plan: str) -> str:
+def create_checkout_session(user: User, plan: str, db: Session) -> str:
     if plan not in PRICE_IDS:
         raise ValueError(f"Invalid plan: {plan}")
 
-    # Create or reuse Stripe customer
+    # Create or reuse Stripe customer; the idempotency key makes double clicks
+    # return the same customer, and we store it before creating the session
     if not user.stripe_customer_id:
         customer = stripe.Customer.create(
             email=user.email,
             name=user.business_name,
             metadata={"user_id": str(user.id)},
+            idempotency_key=f"cust-{user.id}",
         )
-        customer_id = customer.id
-    else:
-        customer_id = user.stripe_customer_id
+        user.stripe_customer_id = customer.id
+        db.commit()
 
     session = stripe.checkout.Session.create(
-        customer=customer_id,
+        customer=user.stripe_customer_id,
         payment_method_types=["card", "ideal"],
         line_items=[{"price": PRICE_IDS[plan], "quantity": 1}],
         mode="subscription",
         success_url=f"{FRONTEND_URL}/dashboard.html?payment=success",
         cancel_url=f"{FRONTEND_URL}/dashboard.html?payment=cancelled",
-        metadata={"user_id": str(user.id), "plan": plan},
+        metadata={"user_id": str(user.id), "plan": plan, "v": "1"},
         allow_promotion_codes=True,
         subscription_data={"trial_period_days": 14},
+        # Repeated clicks within the same minute get the same checkout session back
+        idempotency_key=f"checkout-{user.id}-{plan}-{int(time.time() // 60)}",
     )
     return session.url
 
@@ -59,43 +66,71 @@ def create_portal_session(user: User) -> str:
     return session.url
 
 
-def handle_webhook_event(payload: bytes, sig_header: str, db: Session) -> dict:
+def verify_webhook(payload: bytes, sig_header: str):
+    """Check the Stripe signature only (HMAC over the raw body); the payload is parsed later."""
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, STRIPE_WEBHOOK_SECRET)
+        stripe.WebhookSignature.verify_header(
+            payload.decode("utf-8"), sig_header, STRIPE_WEBHOOK_SECRET, tolerance=300
+        )
     except (ValueError, stripe.error.SignatureVerificationError):
         raise ValueError("Invalid webhook signature")
 
-    if event["type"] == "checkout.session.completed":
-        session = event["data"]["object"]
-        user_id = int(session["metadata"]["user_id"])
-        plan = session["metadata"]["plan"]
-        customer_id = session["customer"]
-        subscription_id = session["subscription"]
-
-        user = db.query(User).filter(User.id == user_id).first()
-        if user:
-            user.plan = plan
-            user.stripe_customer_id = customer_id
-            user.stripe_subscription_id = subscription_id
-            db.commit()
-
-    elif event["type"] == "customer.subscription.deleted":
-        subscription = event["data"]["object"]
-        customer_id = subscription["customer"]
-
-        user = db.query(User).filter(User.stripe_customer_id == customer_id).first()
-        if user:
-            user.plan = "free"
-            user.stripe_subscription_id = None
-            db.commit()
-
-    elif event["type"] == "customer.subscription.updated":
-        subscription = event["data"]["object"]
-        customer_id = subscription["customer"]
-
-        user = db.query(User).filter(User.stripe_customer_id == customer_id).first()
-        if user and subscription["status"] != "active":
-            user.plan = "free"
-            db.commit()
 
+def _on_checkout_completed(event: dict, db: Session) -> None:
+    session = event["data"]["object"]
+    # Sessions not created by create_checkout_session lack our metadata; skip them
+    meta = session.get("metadata") or {}
+    user_id = meta.get("user_id")
+    plan = meta.get("plan")
+    if not user_id or not str(user_id).isdigit() or plan not in PRICE_IDS:
+        print(f"[STRIPE] Ignoring {event.get('type')} {event.get('id')}: missing or invalid checkout metadata")
+        return
+    user_id = int(user_id)
+    customer_id = session["customer"]
+    subscription_id = session["subscription"]
+
+    db.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(plan=plan, stripe_customer_id=customer_id, stripe_subscription_id=subscription_id)
+    )
+    db.commit()
+
+
+def _on_subscription_deleted(event: dict, db: Session) -> None:
+    subscription = event["data"]["object"]
+    customer_id = subscription["customer"]
+
+    db.execute(
+        update(User)
+        .where(User.stripe_customer_id == customer_id)
+        .values(plan="free", stripe_subscription_id=None)
+    )
+    db.commit()
+
+
+def _on_subscription_updated(event: dict, db: Session) -> None:
+    subscription = event["data"]["object"]
+    customer_id = subscription["customer"]
+
+    if subscription["status"] != "active":
+        db.execute(update(User).where(User.stripe_customer_id == customer_id).values(plan="free"))
+        db.commit()
+
+
+def _on_unhandled(event: dict, db: Session) -> None:
+    pass
+
+
+# Stripe event type -> handler
+_HANDLERS: Dict[str, Callable[[dict, Session], None]] = {
+    "checkout.session.completed": _on_checkout_completed,
+    "customer.subscription.deleted": _on_subscription_deleted,
+    "customer.subscription.updated": _on_subscription_updated,
+}
+
+
+def process_webhook_event(payload: bytes, db: Session) -> dict:
+    event = orjson.loads(payload)
+    _HANDLERS.get(event["type"], _on_unhandled)(event, db)
     return {"status": "ok"}
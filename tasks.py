@@ -0,0 +1,39 @@
+"""
+Background jobs that shouldn't hold up an HTTP response (emails).
+
+Jobs run in-process on a small thread pool: the app is deployed as a single web
+process (see Procfile), so there is no broker or separate worker to hand off to.
+Failed jobs can be retried with exponential backoff. Queued jobs live only in
+memory and are lost on restart, so don't use this for work that must not be dropped.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", "4"))
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=TASK_WORKERS, thread_name_prefix="tasks")
+
+
+def _run(fn, args, retry_on, max_retries, retry_delay, attempt):
+    try:
+        fn(*args)
+    except retry_on as e:
+        if attempt >= max_retries:
+            print(f"[TASKS] {fn.__name__} failed after {attempt + 1} attempt(s): {type(e).__name__}: {e}")
+            return
+        # Wait on a timer rather than sleeping, so the worker is free in the meantime
+        timer = threading.Timer(
+            retry_delay * 2 ** attempt,
+            _EXECUTOR.submit,
+            args=(_run, fn, args, retry_on, max_retries, retry_delay, attempt + 1),
+        )
+        timer.daemon = True
+        timer.start()
+    except Exception as e:
+        print(f"[TASKS] {fn.__name__} failed: {type(e).__name__}: {e}")
+
+
+def enqueue(fn, *args, retry_on=(), max_retries: int = 0, retry_delay: float = 30):
+    """Run fn(*args) in the background, retrying on `retry_on` exceptions up to max_retries times."""
+    _EXECUTOR.submit(_run, fn, args, tuple(retry_on), max_retries, retry_delay, 0)